@@ -2,14 +2,27 @@
 # How to use: historical_price_scraper.py --start-date 2025-01-17 --out prices.csv --clean-price --headful
 
 import argparse
+import asyncio
 import csv
+import html
+import json
+import os
+import random
 import sys
 import time
 import re
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
 from datetime import datetime, timedelta, date
 from dateutil import tz
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError, Page, Frame
+from dateutil.easter import easter
+from dateutil.relativedelta import relativedelta, MO, TH
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Frame, Request
+
+try:
+    import httpx  # only needed for --replay-api
+except ImportError:
+    httpx = None
 
 # -------------------- SITE & SELECTORS --------------------
 DEFAULT_URL = "https://www.gapath2college.com/gadtpl/ao/overview.cs"
@@ -33,141 +46,1003 @@ PRICE_CELL_SELECTORS = [
     "#caoBalDiv > table > tbody > tr > td.unite-table-cell.unite-table-cell-2.unite-table-column-unit"
 ]
 
-WAIT_AFTER_SUBMIT_SEC = 0.25
+# Requests we never need: we only read one table cell.
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+BLOCKED_AFTER_LOGIN_TYPES = {"stylesheet"}  # login/MFA pages may need styling to be usable
+BLOCKED_URL_REGEX = re.compile(
+    r"google-analytics\.com|googletagmanager\.com|doubleclick\.net|facebook\.net|"
+    r"hotjar\.com|newrelic\.com|nr-data\.net|omtrdc\.net|demdex\.net|quantserve\.com",
+    re.I,
+)
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/126.0.0.0 Safari/537.36"
+)
+
+NETWORK_QUIET_MS = 300          # no requests in flight for this long = update has landed
+NETWORK_IDLE_TIMEOUT_MS = 2000  # give up waiting for quiet (long-polls, beacons) after this
+PRICE_SETTLE_MS = 300           # in-page fast path: no DOM mutations for this long = final price
 MAX_WAIT_PRICE_MS = 10000
 PER_DAY_RETRIES = 2
-POLITE_DELAY_BETWEEN_DAYS_SEC = 0.35
+RETRY_BACKOFF_BASE_SEC = 0.3
+RETRY_BACKOFF_CAP_SEC = 5.0
+MAX_DAYS_PER_SEC = 3.0      # shared politeness budget across all workers
+WORKER_STAGGER_SEC = 0.1    # offset between worker start times
+LOGIN_WAIT_SEC = 120        # time to complete login/MFA by hand
+SESSION_CHECK_SEC = 5       # how long a still-valid session gets to show the form first
+WORKER_FORM_WAIT_SEC = 30   # extra contexts are already logged in
+CSV_BATCH_ROWS = 100
+CSV_QUEUE_ROWS = 1024
+CSV_BUFFER_BYTES = 1 << 16
+
+# Headers we must not copy from the captured browser request into httpx.
+REPLAY_SKIP_HEADERS = {"cookie", "content-length", "host", "connection", "accept-encoding"}
+# Price cell in an HTML fragment returned by the backend.
+PRICE_CELL_HTML_REGEX = re.compile(r"<td[^>]*unite-table-column-unit[^>]*>(.*?)</td>", re.S | re.I)
+TAG_REGEX = re.compile(r"<[^>]+>")
+# Request fields that would let one call cover a date range, and how wide a range to ask for.
+RANGE_START_KEY_REGEX = re.compile(r"^(start|from|begin)[_-]?date$", re.I)
+RANGE_END_KEY_REGEX = re.compile(r"^(end|to|thru|through)[_-]?date$", re.I)
+RANGE_BATCH_DAYS = 60
+# Backend field names that look like a price (preferred when two values match)
+PRICE_KEY_REGEX = re.compile(r"price|nav|unit.?value", re.I)
+# A price as the page shows it: prefix ("$"), number, suffix
+SAMPLE_PRICE_REGEX = re.compile(r"^(\D*?)(\d[\d,]*(?:\.\d+)?)(\D*)$")
+# Dates inside a range response (MM/DD/YYYY or YYYY-MM-DD)
+RESPONSE_DATE_REGEX = re.compile(r"^\s*(?:(\d{2})/(\d{2})/(\d{4})|(\d{4})-(\d{2})-(\d{2}))")
+
+# Select-all chord for clearing the date field, fixed per platform.
+SELECT_ALL_KEY = "Meta+A" if sys.platform == "darwin" else "Control+A"
+
+# Characters dropped by clean_price's fast path (one C-level pass instead of chained replaces).
+PRICE_STRIP_TABLE = str.maketrans("", "", "$,\u00A0 ")
 
 PRICE_REGEX = re.compile(r"-?\$?\s*([0-9]{1,3}(?:,[0-9]{3})*(?:\.[0-9]{2})|[0-9]+(?:\.[0-9]{2}))")
 
 # -------------------- UTILITIES --------------------
 def to_mmddyyyy(d: date) -> str:
-    return d.strftime("%m/%d/%Y")
+    # Plain formatting; strftime goes through the C locale machinery on every call.
+    return f"{d.month:02d}/{d.day:02d}/{d.year:04d}"
 
-def daterange(start: date, end_inclusive: date):
-    cur = start
-    while cur <= end_inclusive:
-        yield cur
-        cur += timedelta(days=1)
+# A day to scrape as (YYYY-MM-DD for the CSV, MM/DD/YYYY for the form).
+Day = Tuple[str, str]
 
-def first_visible_in_frame(frame: Frame, selectors) -> Optional[str]:
-    for sel in selectors:
-        try:
-            el = frame.query_selector(sel)
-            if el and el.is_visible():
-                return sel
-        except Exception:
-            pass
-    return None
+def observed(d: date) -> date:
+    # Saturday holidays close the Friday before, Sunday ones the Monday after.
+    if d.weekday() == 5:
+        return d - timedelta(days=1)
+    if d.weekday() == 6:
+        return d + timedelta(days=1)
+    return d
+
+def market_holidays(year: int) -> Set[date]:
+    # NYSE full-day closures; fund unit prices aren't published on these.
+    # One-off closures (days of mourning etc.) aren't listed and just get scraped.
+    days = {
+        date(year, 1, 1) + relativedelta(weekday=MO(+3)),    # Martin Luther King Jr. Day
+        date(year, 2, 1) + relativedelta(weekday=MO(+3)),    # Washington's Birthday
+        easter(year) - timedelta(days=2),                    # Good Friday
+        date(year, 5, 31) + relativedelta(weekday=MO(-1)),   # Memorial Day
+        observed(date(year, 7, 4)),                          # Independence Day
+        date(year, 9, 1) + relativedelta(weekday=MO(+1)),    # Labor Day
+        date(year, 11, 1) + relativedelta(weekday=TH(+4)),   # Thanksgiving
+        observed(date(year, 12, 25)),                        # Christmas
+    }
+    # New Year's on a Saturday is not made up on the Friday before
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days.add(observed(new_year))
+    if year >= 2022:
+        days.add(observed(date(year, 6, 19)))                # Juneteenth
+    return days
+
+def build_days(start: date, end_inclusive: date, business_days_only: bool) -> List[Day]:
+    # Format every date once up front; the workers only pass strings around.
+    holidays: Set[date] = set()
+    if business_days_only:
+        for year in range(start.year, end_inclusive.year + 1):
+            holidays |= market_holidays(year)
+    days = []
+    for n in range(start.toordinal(), end_inclusive.toordinal() + 1):
+        d = date.fromordinal(n)
+        if business_days_only and (d.weekday() >= 5 or d in holidays):
+            continue
+        days.append((d.isoformat(), to_mmddyyyy(d)))
+    return days
 
-def find_across_frames(page: Page, selectors) -> Tuple[Optional[Frame], Optional[str]]:
+# Evaluated inside a frame: first selector whose element is rendered (same test as
+# Playwright's is_visible: non-empty box and not visibility:hidden), else null.
+FIRST_VISIBLE_JS = """(sels) => {
+    for (const s of sels) {
+        let el;
+        try { el = document.querySelector(s); } catch (e) { continue; }
+        if (!el) continue;
+        const r = el.getBoundingClientRect();
+        if (r.width > 0 && r.height > 0 && getComputedStyle(el).visibility !== "hidden") return s;
+    }
+    return null;
+}"""
+
+async def first_visible_in_frame(frame: Frame, selectors) -> Optional[str]:
+    # One roundtrip per frame instead of query_selector + is_visible per selector
+    try:
+        return await frame.evaluate(FIRST_VISIBLE_JS, list(selectors))
+    except Exception:
+        return None
+
+async def find_across_frames(page: Page, selectors) -> Tuple[Optional[Frame], Optional[str]]:
     # Try main frame first
-    sel = first_visible_in_frame(page.main_frame, selectors)
+    sel = await first_visible_in_frame(page.main_frame, selectors)
     if sel:
         return page.main_frame, sel
     # Then any child frames
     for fr in page.frames:
         if fr is page.main_frame:
             continue
-        sel = first_visible_in_frame(fr, selectors)
+        sel = await first_visible_in_frame(fr, selectors)
         if sel:
             return fr, sel
     return None, None
 
-def set_date_anywhere(page: Page, target_str_mmddyyyy: str) -> bool:
-    # Prefer input element
-    fr, sel = find_across_frames(page, DATE_INPUT_SELECTORS)
-    if fr and sel:
-        try:
-            el = fr.query_selector(sel)
-            el.click()
-            page.keyboard.press("Control+A" if sys.platform != "darwin" else "Meta+A")
-            page.keyboard.press("Backspace")
-            el.type(target_str_mmddyyyy, delay=20)
-            return True
-        except Exception:
-            pass
-    # Fallback to contenteditable
-    fr, sel = find_across_frames(page, CONTENTEDITABLE_SELECTORS)
-    if fr and sel:
-        try:
-            el = fr.query_selector(sel)
-            el.click()
-            page.keyboard.press("Control+A" if sys.platform != "darwin" else "Meta+A")
-            page.keyboard.press("Backspace")
-            el.type(target_str_mmddyyyy, delay=20)
+async def locate_price_frame(page: Page) -> Tuple[Optional[Frame], Optional[str]]:
+    # Return the first frame/selector where the price cell exists
+    # (not always visible immediately; we'll still try to use it)
+    # Try main frame first
+    frames = [page.main_frame] + [fr for fr in page.frames if fr is not page.main_frame]
+    for fr in frames:
+        for sel in PRICE_CELL_SELECTORS:
+            try:
+                if await fr.locator(sel).count() > 0:
+                    return fr, sel
+            except Exception:
+                pass
+    return None, None
+
+async def locate_price_locator(page: Page):
+    # Return the first locator that exists across frames
+    # (We use locators later for waiting/reading text)
+    fr, sel = await locate_price_frame(page)
+    if not (fr and sel):
+        return None
+    return fr.locator(sel).first
+
+# Resolved (frame, selector) per element role, per page. The page layout doesn't
+# change mid-scrape, so we look each one up once and only re-resolve after a failure.
+RESOLVED: Dict[Page, Dict[str, Optional[Tuple[Frame, str]]]] = {}
+
+def resolved(page: Page) -> Dict[str, Optional[Tuple[Frame, str]]]:
+    return RESOLVED.setdefault(page, {"date": None, "submit": None, "price": None})
+
+async def resolve_role(page: Page, role: str) -> Optional[Tuple[Frame, str]]:
+    if role == "date":
+        # Prefer input element, fall back to contenteditable
+        fr, sel = await find_across_frames(page, DATE_INPUT_SELECTORS)
+        if not (fr and sel):
+            fr, sel = await find_across_frames(page, CONTENTEDITABLE_SELECTORS)
+    elif role == "submit":
+        fr, sel = await find_across_frames(page, SUBMIT_BUTTON_SELECTORS)
+    else:
+        fr, sel = await locate_price_frame(page)
+    resolved(page)[role] = (fr, sel) if fr and sel else None
+    return resolved(page)[role]
+
+async def get_resolved(page: Page, role: str) -> Optional[Tuple[Frame, str]]:
+    return resolved(page)[role] or await resolve_role(page, role)
+
+async def resolve_elements(page: Page) -> bool:
+    # True once the date field and submit button are both on the page.
+    for role in ("date", "submit"):
+        if not await get_resolved(page, role):
+            return False
+    await resolve_role(page, "price")
+    return True
+
+async def wait_for_form(page: Page, timeout_sec: float) -> bool:
+    # Proceed as soon as our target elements are present across frames (and cache them)
+    t0 = time.time()
+    while time.time() - t0 < timeout_sec:
+        if await resolve_elements(page):
             return True
-        except Exception:
-            pass
+        await asyncio.sleep(0.5)
     return False
 
-def click_submit_anywhere(page: Page) -> bool:
-    fr, sel = find_across_frames(page, SUBMIT_BUTTON_SELECTORS)
-    if fr and sel:
+async def with_resolved(page: Page, role: str, action) -> bool:
+    # Run action(frame, sel) on the cached element; on failure (e.g. frame
+    # detached) drop the cache entry and try once more with a fresh lookup.
+    for _ in range(2):
+        hit = await get_resolved(page, role)
+        if not hit:
+            return False
         try:
-            fr.click(sel)
+            await action(*hit)
             return True
         except Exception:
-            return False
+            resolved(page)[role] = None
     return False
 
-def locate_price_locator(page: Page):
-    # Return the first locator that exists/visible across frames
-    # (We use locators later for waiting/reading text)
-    # Try main frame first
-    for sel in PRICE_CELL_SELECTORS:
-        try:
-            loc = page.locator(sel).first
-            if loc and loc.count() > 0:
-                # not always visible immediately; we'll still try to use it
-                return loc
-        except Exception:
-            pass
-    # Fallback: any frame-specific locator
-    for fr in page.frames:
-        for sel in PRICE_CELL_SELECTORS:
-            try:
-                loc = fr.locator(sel).first
-                if loc and loc.count() > 0:
-                    return loc
-            except Exception:
-                pass
-    return None
+async def type_date(page: Page, fr: Frame, sel: str, target_str_mmddyyyy: str):
+    el = await fr.query_selector(sel)
+    await el.click()
+    await page.keyboard.press(SELECT_ALL_KEY)
+    await page.keyboard.press("Backspace")
+    # One IPC for the whole string instead of a keystroke (plus 20 ms) per character
+    await page.keyboard.insert_text(target_str_mmddyyyy)
+    # insert_text fires no key events; let validators/date widgets see the new value
+    await el.dispatch_event("input")
+    await el.dispatch_event("change")
+
+async def set_date_anywhere(page: Page, target_str_mmddyyyy: str) -> bool:
+    # Input or contenteditable, whichever resolve_role found
+    return await with_resolved(page, "date", lambda fr, sel: type_date(page, fr, sel, target_str_mmddyyyy))
 
-def extract_price_text(page: Page) -> str:
+async def click_submit_anywhere(page: Page) -> bool:
+    return await with_resolved(page, "submit", lambda fr, sel: fr.click(sel))
+
+async def extract_price_text(page: Page) -> str:
+    hit = await get_resolved(page, "price")
+    if not hit:
+        return ""
+    fr, sel = hit
     try:
-        loc = locate_price_locator(page)
-        if not loc:
-            return ""
-        return (loc.inner_text() or "").strip()
+        return (await fr.locator(sel).first.inner_text() or "").strip()
     except Exception:
+        resolved(page)["price"] = None
         return ""
 
-def wait_for_price_update(page: Page, prev_text: Optional[str]) -> str:
-    # We search a locator repeatedly; use a function that compares its text.
-    deadline = time.time() + (MAX_WAIT_PRICE_MS / 1000.0)
+# Evaluated inside the browser: resolves as soon as a DOM mutation leaves the cell
+# text different from prev, or with {timedOut: true} and the current text at the deadline.
+PRICE_CHANGED_JS = """(args) => new Promise((resolve) => {
+    const text = () => {
+        const el = document.querySelector(args.sel);
+        return el ? (el.innerText || "").trim() : "";
+    };
+    let settled = false;
+    const done = (timedOut) => {
+        if (settled) return;
+        settled = true;
+        obs.disconnect();
+        clearTimeout(timer);
+        resolve({timedOut, text: text()});
+    };
+    const check = () => {
+        const t = text();
+        if (t && t !== args.prev) done(false);
+    };
+    const obs = new MutationObserver(check);
+    const timer = setTimeout(() => done(true), args.timeout);
+    obs.observe(document.body, {childList: true, subtree: true, characterData: true});
+    check();
+})"""
+
+async def poll_price_update(loc, prev_text: Optional[str], deadline: float) -> str:
+    # Python-side polling; only used when the in-browser wait can't run.
     last = None
     while time.time() < deadline:
-        txt = extract_price_text(page)
+        try:
+            txt = (await loc.inner_text() or "").strip() if loc else ""
+        except Exception:
+            txt = ""
         last = txt
         if prev_text:
             if txt and txt != prev_text:
-                return txt.strip()
+                return txt
         else:
             if txt:
-                return txt.strip()
-        time.sleep(0.15)
+                return txt
+        await asyncio.sleep(0.15)
     # Timeout: return whatever we last saw (may be empty)
     return (last or "").strip()
 
+async def wait_for_price_update(page: Page, prev_text: Optional[str]) -> str:
+    # Resolve the price cell's frame once, then let the browser watch for the change.
+    deadline = time.time() + (MAX_WAIT_PRICE_MS / 1000.0)
+    hit = await get_resolved(page, "price")
+    if not hit:
+        return await poll_price_update(await locate_price_locator(page), prev_text, deadline)
+    fr, sel = hit
+    try:
+        # Re-checks only when the DOM actually changes, not on a timer
+        res = await fr.evaluate(
+            PRICE_CHANGED_JS, {"sel": sel, "prev": prev_text or "", "timeout": MAX_WAIT_PRICE_MS}
+        )
+        # On timeout this is whatever the cell shows now (may be empty)
+        return (res["text"] or "").strip()
+    except Exception:
+        # Frame detached or navigated mid-wait; fall back to Python-side polling.
+        resolved(page)["price"] = None
+        return await poll_price_update(await locate_price_locator(page), prev_text, deadline)
+
 def clean_price(raw: str) -> str:
     if not raw:
         return ""
+    # Fast path: the cell is usually just "$NN.NN" / "$N,NNN.NN"
+    simple = raw.translate(PRICE_STRIP_TABLE).strip()
+    whole, dot, cents = simple.partition(".")
+    if dot and len(cents) == 2 and (whole + cents).isascii() and (whole + cents).isdigit():
+        return simple
     m = PRICE_REGEX.search(raw.replace("\u00A0", " ").strip())
     if not m:
         return raw.strip()
     return m.group(1).replace(",", "")
 
+def read_done_dates(path: str, retry_blank: bool) -> Tuple[Set[str], int]:
+    # ISO dates already in an earlier run's CSV, plus how many of those rows have no
+    # price. With retry_blank, such rows are dropped from the file first, so
+    # re-scraping them can't leave a blank and a filled row for the same date.
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = [row for row in csv.reader(f) if row]
+    except FileNotFoundError:
+        return set(), 0
+    if retry_blank:
+        kept = [row for row in rows if row[0] == "date" or (len(row) >= 2 and row[1])]
+        if len(kept) != len(rows):
+            tmp = path + ".tmp"
+            with open(tmp, "w", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerows(kept)
+            os.replace(tmp, path)
+        rows = kept
+    dated = [row for row in rows if row[0] != "date"]
+    return {row[0] for row in dated}, sum(1 for row in dated if len(row) < 2 or not row[1])
+
+class RateLimiter:
+    # Hands out evenly spaced start slots (async with limiter: ...), so slow
+    # responses aren't padded with an extra fixed delay the way sleep() was.
+    def __init__(self, per_sec: float):
+        self.interval = 1.0 / per_sec
+        self.next_allowed = 0.0
+
+    async def __aenter__(self):
+        now = time.monotonic()
+        slot = max(self.next_allowed, now)
+        self.next_allowed = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def __aexit__(self, *exc):
+        return False
+
+class CsvWriterTask:
+    # Workers enqueue rows (await writer.writerow(...)); a single task drains the
+    # queue and writes whatever has piled up in one writerows() call.
+    def __init__(self, f, batch_rows: int = CSV_BATCH_ROWS, maxsize: int = CSV_QUEUE_ROWS):
+        self.f = f
+        self.writer = csv.writer(f)
+        self.batch_rows = batch_rows
+        self.queue: "asyncio.Queue[Optional[list]]" = asyncio.Queue(maxsize)
+        self.task = asyncio.create_task(self.drain())
+
+    async def put(self, item):
+        # Race a blocked put against the drain task: if a write failed, nothing empties
+        # the queue any more, so re-raise its error instead of waiting forever.
+        if not self.task.done():
+            if not self.queue.full():
+                self.queue.put_nowait(item)
+                return
+            put = asyncio.ensure_future(self.queue.put(item))
+            await asyncio.wait({put, self.task}, return_when=asyncio.FIRST_COMPLETED)
+            if put.done():
+                return
+            put.cancel()
+        self.task.result()
+        raise RuntimeError("CSV writer has already stopped")
+
+    async def writerow(self, row):
+        await self.put(row)
+
+    async def drain(self):
+        unflushed = 0
+        done = False
+        while not done:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_rows and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if None in batch:  # EOF sentinel from close()
+                batch = batch[:batch.index(None)]
+                done = True
+            self.writer.writerows(batch)
+            unflushed += len(batch)
+            if unflushed >= self.batch_rows:
+                self.f.flush()
+                unflushed = 0
+        self.f.flush()
+
+    async def close(self):
+        await self.put(None)
+        await self.task
+
+async def block_nonessential(context: BrowserContext, after_login: bool):
+    # Abort images/fonts/media (and stylesheets once logged in) plus analytics beacons.
+    blocked = BLOCKED_RESOURCE_TYPES | (BLOCKED_AFTER_LOGIN_TYPES if after_login else set())
+
+    async def handler(route):
+        req = route.request
+        if req.resource_type in blocked or BLOCKED_URL_REGEX.search(req.url):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    await context.unroute("**/*")
+    await context.route("**/*", handler)
+
+class NetworkIdleTracker:
+    # Counts a page's in-flight requests so we can wait for a quiet spell after submit
+    # instead of sleeping a fixed guess.
+    def __init__(self, page: Page):
+        self.inflight = 0
+        self.last_change = time.monotonic()
+        page.on("request", self.started)
+        page.on("requestfinished", self.finished)
+        page.on("requestfailed", self.finished)
+
+    def started(self, _):
+        self.inflight += 1
+        self.last_change = time.monotonic()
+
+    def finished(self, _):
+        self.inflight = max(0, self.inflight - 1)
+        self.last_change = time.monotonic()
+
+    def mark(self):
+        # Restart the quiet window now, e.g. right before a submit whose requests
+        # may not have been reported yet.
+        self.last_change = time.monotonic()
+
+    async def wait_idle(self, quiet_ms: int, timeout_ms: int) -> bool:
+        # Local bookkeeping only: no browser roundtrips while we wait.
+        deadline = time.monotonic() + timeout_ms / 1000.0
+        while time.monotonic() < deadline:
+            if self.inflight == 0 and (time.monotonic() - self.last_change) * 1000 >= quiet_ms:
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+IDLE_TRACKERS: Dict[Page, NetworkIdleTracker] = {}
+
+def retry_delay(attempt: int) -> float:
+    # Exponential backoff with jitter, so parallel workers don't retry in lockstep.
+    return min(RETRY_BACKOFF_CAP_SEC, RETRY_BACKOFF_BASE_SEC * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+def idle_tracker(page: Page) -> NetworkIdleTracker:
+    if page not in IDLE_TRACKERS:
+        IDLE_TRACKERS[page] = NetworkIdleTracker(page)
+    return IDLE_TRACKERS[page]
+
+# -------------------- SCRAPING --------------------
+def build_submit_js(date_sel: str, submit_sel: str, price_sel: str) -> str:
+    # One in-page call per day: set the date, submit, and resolve with
+    # {applied, timedOut, text}. The new text only counts once it looks like a price and
+    # has stayed unchanged for PRICE_SETTLE_MS, so a "Loading..." placeholder isn't taken
+    # as the price however long the backend takes.
+    return f"""async (args) => {{
+    const inp = document.querySelector({json.dumps(date_sel)});
+    const btn = document.querySelector({json.dumps(submit_sel)});
+    if (!inp || !btn) return null;
+    const text = () => {{
+        const el = document.querySelector({json.dumps(price_sel)});
+        return el ? (el.innerText || "").trim() : "";
+    }};
+    // Native setter so framework-managed inputs notice the change too
+    Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, "value").set.call(inp, args.mmddyyyy);
+    inp.dispatchEvent(new Event("input", {{bubbles: true}}));
+    inp.dispatchEvent(new Event("change", {{bubbles: true}}));
+    if (inp.value !== args.mmddyyyy) return {{applied: false, timedOut: false, text: text()}};
+    btn.click();
+    return await new Promise((resolve) => {{
+        let settled = false;
+        let settle = null;
+        const done = (timedOut) => {{
+            if (settled) return;
+            settled = true;
+            obs.disconnect();
+            clearTimeout(timer);
+            clearTimeout(settle);
+            resolve({{applied: true, timedOut, text: text()}});
+        }};
+        const looksLikePrice = new RegExp({json.dumps(SAMPLE_PRICE_REGEX.pattern)});
+        let last = null;
+        const check = () => {{
+            // Only a change to the cell itself restarts the quiet window; a placeholder
+            // ("--", "Loading...") stops it until a price-looking value shows up.
+            const t = text();
+            if (t === last) return;
+            last = t;
+            clearTimeout(settle);
+            settle = null;
+            if (t !== args.prev && looksLikePrice.test(t)) settle = setTimeout(() => done(false), {PRICE_SETTLE_MS});
+        }};
+        const obs = new MutationObserver(check);
+        const timer = setTimeout(() => done(true), {MAX_WAIT_PRICE_MS});
+        obs.observe(document.body, {{childList: true, subtree: true, characterData: true}});
+        check();
+    }});
+}}"""
+
+# Per page: (frame, generated JS) once built, False once it proved unusable there.
+FAST_PATH: Dict[Page, object] = {}
+
+async def fast_path(page: Page) -> Optional[Tuple[Frame, str]]:
+    # Only when all three elements live in one frame and the date field is a plain <input>.
+    if page not in FAST_PATH:
+        hits = [await get_resolved(page, role) for role in ("date", "submit", "price")]
+        ok = all(hits) and len({fr for fr, _ in hits}) == 1
+        if ok:
+            fr = hits[0][0]
+            try:
+                ok = await fr.evaluate("(s) => document.querySelector(s) instanceof HTMLInputElement", hits[0][1])
+            except Exception:
+                ok = False
+        FAST_PATH[page] = (fr, build_submit_js(*(sel for _, sel in hits))) if ok else False
+    return FAST_PATH[page] or None
+
+async def scrape_day(page: Page, mmddyyyy: str, prev_text: str) -> str:
+    # prev_text is what the cell showed before this submit; returns the raw new cell text.
+    # With no previous text we couldn't tell a stale cell from an update, so take the slow path.
+    fast = await fast_path(page) if prev_text else None
+    if fast:
+        fr, js = fast
+        try:
+            res = await fr.evaluate(js, {"mmddyyyy": mmddyyyy, "prev": prev_text})
+        except Exception:
+            res = None
+        if res and res["applied"]:
+            # On timeout this is whatever the cell shows now, same as the slow path
+            # (a price can legitimately repeat from one day to the next).
+            return res["text"]
+        # The elements went away or the input rejected a plain value set: step by step from now on
+        FAST_PATH[page] = False
+
+    if not await set_date_anywhere(page, mmddyyyy):
+        raise RuntimeError(
+            "Could not locate a date field (tried multiple selectors and frames). "
+            "If you just logged in, refresh or navigate to Account Overview."
+        )
+
+    # Some widgets need Enter or blur
+    try:
+        await page.keyboard.press("Enter")
+    except Exception:
+        pass
+
+    tracker = idle_tracker(page)
+    # At least NETWORK_QUIET_MS after submit, even if its requests surface late
+    tracker.mark()
+    if not await click_submit_anywhere(page):
+        raise RuntimeError("Could not find/press the submit/update button.")
+
+    # Let the submit's requests settle so we don't read an optimistic/stale cell
+    await tracker.wait_idle(NETWORK_QUIET_MS, NETWORK_IDLE_TIMEOUT_MS)
+
+    return await wait_for_price_update(page, prev_text if prev_text else None)
+
+async def worker(page: Page, dates: "asyncio.Queue[Day]", writer, limiter: RateLimiter, args):
+    # Pull dates until the queue is drained; each worker owns one page.
+    # The cell's current text is carried from day to day rather than re-read before each submit.
+    prev_text = await extract_price_text(page)
+    consecutive_failures = 0
+    while True:
+        try:
+            iso, mmddyyyy = dates.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        last_error = None
+
+        for attempt in range(1, PER_DAY_RETRIES + 2):
+            try:
+                async with limiter:
+                    new_text = await scrape_day(page, mmddyyyy, prev_text)
+                prev_text = new_text
+                consecutive_failures = 0
+                await writer.writerow([iso, clean_price(new_text) if args.clean_price else new_text])
+                break
+            except Exception as e:
+                last_error = e
+                consecutive_failures += 1
+                if attempt <= PER_DAY_RETRIES:
+                    await asyncio.sleep(retry_delay(attempt))
+                    try:
+                        if consecutive_failures >= 2:
+                            # Page looks wedged; a reload costs far more than one more try, so only now
+                            await page.reload(wait_until="domcontentloaded")
+                            resolved(page).update(date=None, submit=None, price=None)
+                            if FAST_PATH.get(page) is not False:
+                                FAST_PATH.pop(page, None)
+                            await wait_for_form(page, WORKER_FORM_WAIT_SEC)
+                            consecutive_failures = 0
+                        else:
+                            await page.evaluate("window.scrollTo(0, 0);")
+                    except Exception:
+                        pass
+                # We no longer know what the cell shows; resync once
+                prev_text = await extract_price_text(page)
+                if attempt <= PER_DAY_RETRIES:
+                    continue
+                sys.stderr.write("[WARN] {}: {}\n".format(iso, last_error))
+                await writer.writerow([iso, ""])
+
+async def staggered(delay: float, coro):
+    await asyncio.sleep(delay)
+    return await coro
+
+async def open_worker_page(browser: Optional[Browser], context: BrowserContext, state, url: str) -> Optional[Page]:
+    # Extra page sharing the login session; None if the form never shows up.
+    # A persistent profile has no Browser to spawn contexts from, so its workers
+    # are just more tabs in the same (already logged-in) context.
+    if browser is None:
+        page = await context.new_page()
+        owner = page
+    else:
+        owner = await browser.new_context(user_agent=USER_AGENT, storage_state=state)
+        await block_nonessential(owner, after_login=True)
+        page = await owner.new_page()
+    try:
+        await page.goto(url, wait_until="domcontentloaded")
+        if await wait_for_form(page, WORKER_FORM_WAIT_SEC):
+            return page
+    except Exception:
+        pass
+    sys.stderr.write("[WARN] Extra browser page could not reach the overview page; skipping it.\n")
+    await owner.close()
+    return None
+
+# -------------------- API REPLAY --------------------
+class SessionExpired(Exception):
+    pass
+
+class ReplayTemplate:
+    # The backend request behind the submit button, with the date swapped for placeholders.
+    PLACEHOLDER = "{{ASOF_DATE}}"
+    PLACEHOLDER_ENC = "{{ASOF_DATE_ENC}}"
+
+    def __init__(self, method: str, url: str, headers: Dict[str, str], body: Optional[str]):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.body = body
+        # Set by pick_price_field: which response value is the price, and how the page shows it
+        self.price_field: Optional[str] = None
+        self.sample: Optional[str] = None
+
+    @classmethod
+    def templatize(cls, text: str, mmddyyyy: str) -> Tuple[str, bool]:
+        # Replace the submitted date (raw or percent-encoded) with a placeholder.
+        enc = quote(mmddyyyy, safe="")
+        out = text.replace(mmddyyyy, cls.PLACEHOLDER).replace(enc, cls.PLACEHOLDER_ENC)
+        out = out.replace(enc.lower(), cls.PLACEHOLDER_ENC)
+        return out, out != text
+
+    def fill(self, text: str, mmddyyyy: str) -> str:
+        return text.replace(self.PLACEHOLDER, mmddyyyy).replace(self.PLACEHOLDER_ENC, quote(mmddyyyy, safe=""))
+
+    def render(self, mmddyyyy: str) -> Tuple[str, Optional[str]]:
+        body = self.fill(self.body, mmddyyyy) if self.body is not None else None
+        return self.fill(self.url, mmddyyyy), body
+
+    def pick_price_field(self, text: str, browser_text: str) -> bool:
+        # Keep the one response value that reproduces what the browser showed for
+        # the same date (fields named like a price win ties).
+        values = response_values(text)
+        paths = sorted(values, key=lambda k: not PRICE_KEY_REGEX.search(k.rsplit(".", 1)[-1]))
+        for path in paths:
+            if format_like(values[path], browser_text) == browser_text:
+                self.price_field, self.sample = path, browser_text
+                return True
+        return False
+
+    def price_from(self, text: str) -> Optional[str]:
+        value = response_values(text).get(self.price_field)
+        return format_like(value, self.sample) if value else None
+
+async def build_replay_templates(requests: List[Request], mmddyyyy: str) -> List[ReplayTemplate]:
+    # Every XHR/fetch that carried the date we just submitted; calibration picks one.
+    templates = []
+    for req in requests:
+        if req.resource_type not in ("xhr", "fetch", "document"):
+            continue
+        url, in_url = ReplayTemplate.templatize(req.url, mmddyyyy)
+        body, in_body = ReplayTemplate.templatize(req.post_data or "", mmddyyyy)
+        if not (in_url or in_body):
+            continue
+        headers = {
+            k: v for k, v in (await req.all_headers()).items()
+            if not k.startswith(":") and k.lower() not in REPLAY_SKIP_HEADERS
+        }
+        templates.append(ReplayTemplate(req.method, url, headers, body if req.post_data is not None else None))
+    return templates
+
+def json_values(obj, path: str, out: Dict[str, str]) -> Dict[str, str]:
+    # Flatten JSON scalars to {"rows.0.unitPrice": "12.34", ...}
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            json_values(v, "{}.{}".format(path, k) if path else str(k), out)
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            json_values(v, "{}.{}".format(path, i) if path else str(i), out)
+    elif obj is not None and not isinstance(obj, bool):
+        out[path] = str(obj)
+    return out
+
+def response_values(text: str) -> Dict[str, str]:
+    # Candidate price values in a backend response, keyed by where they sit.
+    try:
+        return json_values(json.loads(text), "", {})
+    except ValueError:
+        pass
+    # HTML fragment: same cell the browser path reads
+    return {
+        "html.{}".format(i): " ".join(html.unescape(TAG_REGEX.sub("", cell)).split())
+        for i, cell in enumerate(PRICE_CELL_HTML_REGEX.findall(text))
+    }
+
+def format_like(value: str, sample: str) -> str:
+    # Render a backend value the way the page's cell shows prices (12.3 -> "$12.30"),
+    # so API rows and browser rows in one CSV look the same.
+    m = SAMPLE_PRICE_REGEX.match(sample.strip())
+    if not m:
+        return value.strip()
+    prefix, number, suffix = m.groups()
+    try:
+        x = float(value.translate(PRICE_STRIP_TABLE).strip())
+    except ValueError:
+        return value.strip()
+    decimals = len(number.partition(".")[2])
+    return "{}{:,.{}f}{}".format(prefix, x, decimals, suffix)
+
+async def send(client, tmpl: ReplayTemplate, url: str, body: Optional[str]) -> str:
+    resp = await client.request(tmpl.method, url, content=body, headers=tmpl.headers)
+    if resp.status_code in (401, 403) or resp.is_redirect:
+        raise SessionExpired("API replay got HTTP {}".format(resp.status_code))
+    resp.raise_for_status()
+    return resp.text
+
+async def replay_day(client, tmpl: ReplayTemplate, mmddyyyy: str) -> str:
+    url, body = tmpl.render(mmddyyyy)
+    price = tmpl.price_from(await send(client, tmpl, url, body))
+    if not price:
+        raise RuntimeError("No price found in API response.")
+    return price
+
+async def calibrate(client, templates: List[ReplayTemplate], day: Day, browser_text: str) -> Optional[ReplayTemplate]:
+    # Replay the date the browser just scraped; trust only a request/field that gives the same price.
+    for tmpl in templates:
+        url, body = tmpl.render(day[1])
+        try:
+            if tmpl.pick_price_field(await send(client, tmpl, url, body), browser_text):
+                return tmpl
+        except SessionExpired:
+            raise
+        except Exception:
+            continue
+    return None
+
+def iso_from_text(text: str) -> Optional[str]:
+    m = RESPONSE_DATE_REGEX.match(text)
+    if not m:
+        return None
+    if m.group(3):
+        return "{}-{}-{}".format(m.group(3), m.group(1), m.group(2))
+    return "{}-{}-{}".format(m.group(4), m.group(5), m.group(6))
+
+class RangeReplay:
+    # The captured request rewritten to ask for start..end in one call, when it
+    # carries start/end date fields (in the query string, a form body or a JSON body).
+    def __init__(self, tmpl: ReplayTemplate, where: str, start_key: str, end_key: str):
+        self.tmpl = tmpl
+        self.where = where
+        self.start_key = start_key
+        self.end_key = end_key
+        # Set by pick_fields: which row keys hold the as-of date and the price
+        self.date_key: Optional[str] = None
+        self.price_key: Optional[str] = None
+
+    @staticmethod
+    def range_keys(keys) -> Optional[Tuple[str, str]]:
+        start = next((k for k in keys if RANGE_START_KEY_REGEX.match(k)), None)
+        end = next((k for k in keys if RANGE_END_KEY_REGEX.match(k)), None)
+        return (start, end) if start and end else None
+
+    @classmethod
+    def detect(cls, tmpl: ReplayTemplate) -> Optional["RangeReplay"]:
+        if tmpl.body:
+            try:
+                obj = json.loads(tmpl.body)
+                if isinstance(obj, dict) and cls.range_keys(obj):
+                    return cls(tmpl, "json", *cls.range_keys(obj))
+            except ValueError:
+                keys = [k for k, _ in parse_qsl(tmpl.body, keep_blank_values=True)]
+                if cls.range_keys(keys):
+                    return cls(tmpl, "form", *cls.range_keys(keys))
+        keys = [k for k, _ in parse_qsl(urlsplit(tmpl.url).query, keep_blank_values=True)]
+        if cls.range_keys(keys):
+            return cls(tmpl, "query", *cls.range_keys(keys))
+        return None
+
+    def set_pairs(self, qs: str, first: str, last: str) -> str:
+        pairs = parse_qsl(qs, keep_blank_values=True)
+        values = {self.start_key: first, self.end_key: last}
+        return urlencode([(k, values.get(k, v)) for k, v in pairs])
+
+    def render(self, first: str, last: str) -> Tuple[str, Optional[str]]:
+        url, body = self.tmpl.render(first)
+        if self.where == "json":
+            obj = json.loads(body)
+            obj[self.start_key], obj[self.end_key] = first, last
+            body = json.dumps(obj)
+        elif self.where == "form":
+            body = self.set_pairs(body, first, last)
+        else:
+            parts = urlsplit(url)
+            url = urlunsplit(parts._replace(query=self.set_pairs(parts.query, first, last)))
+        return url, body
+
+    def pick_fields(self, text: str, sample_iso: str, browser_text: str) -> bool:
+        # Find the row for the browser-scraped date and keep the date/price keys that
+        # reproduce it. Among date keys, prefer one whose values tell the rows apart.
+        rows = dated_rows(json.loads(text), [])
+        for row in rows:
+            date_keys = [k for k, v in row.items() if isinstance(v, str) and iso_from_text(v) == sample_iso]
+            price_keys = sorted(
+                (k for k, v in row.items()
+                 if not isinstance(v, (dict, list, bool)) and v is not None
+                 and format_like(str(v), browser_text) == browser_text),
+                key=lambda k: not PRICE_KEY_REGEX.search(k),
+            )
+            if date_keys and price_keys:
+                date_keys.sort(key=lambda k: len({str(r.get(k)) for r in rows}), reverse=True)
+                self.date_key, self.price_key = date_keys[0], price_keys[0]
+                return True
+        return False
+
+    def prices_from(self, text: str) -> Dict[str, str]:
+        # {iso: price formatted like the page} from a range response
+        out: Dict[str, str] = {}
+        for row in dated_rows(json.loads(text), []):
+            iso = iso_from_text(str(row.get(self.date_key, "")))
+            value = row.get(self.price_key)
+            if iso and value is not None and not isinstance(value, (dict, list)):
+                out[iso] = format_like(str(value), self.tmpl.sample)
+        return out
+
+def dated_rows(obj, out: List[dict]) -> List[dict]:
+    # Every JSON object carrying at least one date-looking string value.
+    if isinstance(obj, list):
+        for v in obj:
+            dated_rows(v, out)
+    elif isinstance(obj, dict):
+        if any(isinstance(v, str) and iso_from_text(v) for v in obj.values()):
+            out.append(obj)
+        for v in obj.values():
+            if isinstance(v, (dict, list)):
+                dated_rows(v, out)
+    return out
+
+async def replay_range(client, rr: RangeReplay, first: Day, last: Day) -> str:
+    url, body = rr.render(first[1], last[1])
+    return await send(client, rr.tmpl, url, body)
+
+def chunk_days(days: List[Day], span: int) -> List[List[Day]]:
+    # Consecutive runs of days whose first..last covers at most `span` calendar days.
+    chunks: List[List[Day]] = []
+    for day in days:
+        if chunks and (date.fromisoformat(day[0]) - date.fromisoformat(chunks[-1][0][0])).days < span:
+            chunks[-1].append(day)
+        else:
+            chunks.append([day])
+    return chunks
+
+async def capture_replay_templates(page: Page, day: Day) -> Tuple[Optional[str], List[ReplayTemplate]]:
+    # Scrape one date in the browser while recording the requests it fires.
+    # Returns the raw cell text (the calibration sample) and the candidate requests.
+    captured: List[Request] = []
+    listener = lambda r: captured.append(r)
+    page.on("request", listener)
+    try:
+        mmddyyyy = day[1]
+        new_text = await scrape_day(page, mmddyyyy, await extract_price_text(page))
+        return new_text, await build_replay_templates(captured, mmddyyyy)
+    except Exception as e:
+        sys.stderr.write("[WARN] Could not capture the price API request: {}\n".format(e))
+        return None, []
+    finally:
+        page.remove_listener("request", listener)
+
+async def replay_dates(context: BrowserContext, templates: List[ReplayTemplate], sample: Tuple[Day, str],
+                       days: List[Day], writer, limiter: RateLimiter, args) -> List[Day]:
+    # Fetch dates straight from the backend; returns the ones the browser must redo.
+    leftovers: List[Day] = []
+    expired = False
+    sem = asyncio.Semaphore(args.concurrency)
+    cookies = httpx.Cookies()
+    for c in await context.cookies():
+        cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"])
+
+    async def write_price(day: Day, new_text: str):
+        await writer.writerow([day[0], clean_price(new_text) if args.clean_price else new_text])
+
+    def session_expired(e: SessionExpired):
+        # Session is gone; hand everything left back to the browser.
+        nonlocal expired
+        if not expired:
+            sys.stderr.write("[WARN] {}; falling back to the browser.\n".format(e))
+        expired = True
+
+    async with httpx.AsyncClient(cookies=cookies, timeout=MAX_WAIT_PRICE_MS / 1000.0) as client:
+        try:
+            tmpl = await calibrate(client, templates, *sample)
+        except SessionExpired as e:
+            session_expired(e)
+            return days
+        if not tmpl:
+            sys.stderr.write("[WARN] No captured request reproduced the browser's price; using the browser.\n")
+            return days
+
+        # Batched: only if the request has start/end fields and a probe over the
+        # browser-scraped day plus the next two reproduces the browser's price and
+        # comes back with a row for each day.
+        rr = RangeReplay.detect(tmpl)
+        if rr and days:
+            sample_day, sample_text = sample
+            probe_days = days[:2]
+            try:
+                async with limiter:
+                    text = await replay_range(client, rr, sample_day, probe_days[-1])
+                probe = rr.prices_from(text) if rr.pick_fields(text, sample_day[0], sample_text) else {}
+            except SessionExpired as e:
+                session_expired(e)
+                return days
+            except Exception:
+                probe = {}
+            if all(probe.get(day[0]) for day in probe_days):
+                for day in probe_days:
+                    await write_price(day, probe[day[0]])
+                missed: List[Day] = []
+
+                async def batch(chunk: List[Day]):
+                    async with sem:
+                        if expired:
+                            leftovers.extend(chunk)
+                            return
+                        try:
+                            async with limiter:
+                                prices = rr.prices_from(await replay_range(client, rr, chunk[0], chunk[-1]))
+                        except SessionExpired as e:
+                            session_expired(e)
+                            leftovers.extend(chunk)
+                            return
+                        except Exception:
+                            prices = {}
+                        for day in chunk:
+                            if prices.get(day[0]):
+                                await write_price(day, prices[day[0]])
+                            else:
+                                missed.append(day)
+
+                await asyncio.gather(*[batch(c) for c in chunk_days(days[len(probe_days):], RANGE_BATCH_DAYS)])
+                # Days a range didn't cover fall through to one call each
+                days = sorted(missed)
+
+        async def one(day: Day):
+            async with sem:
+                if expired:
+                    leftovers.append(day)
+                    return
+                try:
+                    async with limiter:
+                        new_text = await replay_day(client, tmpl, day[1])
+                except SessionExpired as e:
+                    session_expired(e)
+                    leftovers.append(day)
+                    return
+                except Exception:
+                    leftovers.append(day)
+                    return
+                await write_price(day, new_text)
+
+        await asyncio.gather(*[one(d) for d in days])
+    return sorted(leftovers)
+
 # -------------------- MAIN --------------------
 def main():
     ap = argparse.ArgumentParser(description="Download historical prices to CSV by iterating dates.")
@@ -177,9 +1052,21 @@ def main():
     ap.add_argument("--headful", action="store_true", help="Run with a visible browser (recommended for login/MFA).")
     ap.add_argument("--slowmo", type=int, default=0, help="Slowdown in ms (e.g., 200).")
     ap.add_argument("--clean-price", action="store_true", help="Normalize price text to decimal.")
-    return run(ap.parse_args())
+    ap.add_argument("--retry-blank", action="store_true",
+                    help="When resuming, drop rows with no price from --out and scrape those dates again.")
+    ap.add_argument("--force", action="store_true",
+                    help="Rewrite --out from scratch instead of skipping dates it already has a row for (see --retry-blank).")
+    ap.add_argument("--include-weekends", action="store_true",
+                    help="Also query weekends and market holidays (no new price is published on those days).")
+    ap.add_argument("--concurrency", type=int, default=1,
+                    help="Browser contexts scraping in parallel (rows may be written out of date order when > 1).")
+    ap.add_argument("--profile-dir", default=None,
+                    help="Keep a persistent browser profile here so the login/MFA session carries over between runs.")
+    ap.add_argument("--replay-api", action="store_true",
+                    help="After one date in the browser, replay its backend request over HTTP for the rest (needs httpx).")
+    return asyncio.run(run(ap.parse_args()))
 
-def run(args):
+async def run(args):
     try:
         start = datetime.strptime(args.start_date, "%Y-%m-%d").date()
     except ValueError:
@@ -191,92 +1078,100 @@ def run(args):
         print("Error: --start-date cannot be in the future.", file=sys.stderr)
         sys.exit(1)
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=not args.headful, slow_mo=args.slowmo)
-        context = browser.new_context(
-            user_agent=(
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/126.0.0.0 Safari/537.36"
+    if args.concurrency < 1:
+        print("Error: --concurrency must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.replay_api and httpx is None:
+        print("Error: --replay-api needs httpx (pip install httpx).", file=sys.stderr)
+        sys.exit(1)
+
+    remaining = build_days(start, today_local, business_days_only=not args.include_weekends)
+    resume = not args.force and os.path.exists(args.out) and os.path.getsize(args.out) > 0
+    if resume:
+        done, blank = read_done_dates(args.out, args.retry_blank)
+        if blank:
+            # e.g. left by a run whose login failed or session expired; those dates are skipped too
+            print("Note: {} dates in {} have no price; use --retry-blank to scrape them again.".format(blank, args.out))
+        remaining = [day for day in remaining if day[0] not in done]
+        if not remaining:
+            print("Nothing to do: {} already has every date.".format(args.out))
+            return
+        print("Resuming: {} dates already in {}, {} to go.".format(len(done), args.out, len(remaining)))
+
+    async with async_playwright() as p:
+        if args.profile_dir:
+            # Cookies, local storage and MFA trust survive between runs
+            browser = None
+            context = await p.chromium.launch_persistent_context(
+                args.profile_dir, headless=not args.headful, slow_mo=args.slowmo, user_agent=USER_AGENT
             )
-        )
-        page = context.new_page()
+        else:
+            browser = await p.chromium.launch(headless=not args.headful, slow_mo=args.slowmo)
+            context = await browser.new_context(user_agent=USER_AGENT)
+        await block_nonessential(context, after_login=False)
+        page = context.pages[0] if context.pages else await context.new_page()
 
         # 1) Go to overview; if redirected to login, log in manually (since MFA)
-        page.goto(args.url, wait_until="domcontentloaded")
-
-        if args.headful:
-            print("\nIf you see a login page or MFA, complete it manually. "
-                  "Once you reach Account Overview, leave the tab open; the script will proceed.\n")
-
-        # Give you time to log in if needed
-        # (We’ll also proceed immediately if the elements are already present.)
-        t0 = time.time()
-        while time.time() - t0 < 120:  # up to 2 minutes to log in
-            # Check if our target elements are present across frames
-            fr_input, sel_input = find_across_frames(page, DATE_INPUT_SELECTORS)
-            fr_ce, sel_ce = find_across_frames(page, CONTENTEDITABLE_SELECTORS)
-            fr_btn, sel_btn = find_across_frames(page, SUBMIT_BUTTON_SELECTORS)
-            if (fr_input and sel_input) or (fr_ce and sel_ce):
-                if fr_btn and sel_btn:
-                    break
-            time.sleep(0.5)
-
-        # CSV
-        with open(args.out, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["date", "close"])
-
-            cur = start
-            while cur <= today_local:
-                mmddyyyy = to_mmddyyyy(cur)
-                last_error = None
-
-                for attempt in range(1, PER_DAY_RETRIES + 2):
-                    try:
-                        prev_text = extract_price_text(page)
+        await page.goto(args.url, wait_until="domcontentloaded")
 
-                        if not set_date_anywhere(page, mmddyyyy):
-                            raise RuntimeError(
-                                "Could not locate a date field (tried multiple selectors and frames). "
-                                "If you just logged in, refresh or navigate to Account Overview."
-                            )
+        # A saved profile may still be logged in: only prompt if the form doesn't show up
+        # on its own. (Cookies alone prove nothing; consent/load-balancer cookies outlive
+        # the auth session.)
+        if not await wait_for_form(page, SESSION_CHECK_SEC):
+            if args.headful:
+                print("\nIf you see a login page or MFA, complete it manually. "
+                      "Once you reach Account Overview, leave the tab open; the script will proceed.\n")
 
-                        # Some widgets need Enter or blur
-                        try:
-                            page.keyboard.press("Enter")
-                        except Exception:
-                            pass
-
-                        if not click_submit_anywhere(page):
-                            raise RuntimeError("Could not find/press the submit/update button.")
-
-                        time.sleep(WAIT_AFTER_SUBMIT_SEC)
-
-                        new_text = wait_for_price_update(page, prev_text if prev_text else None)
-                        price_out = clean_price(new_text) if args.clean_price else new_text
-
-                        writer.writerow([cur.isoformat(), price_out])
-                        time.sleep(POLITE_DELAY_BETWEEN_DAYS_SEC)
-                        break
-                    except Exception as e:
-                        last_error = e
-                        if attempt <= PER_DAY_RETRIES:
-                            time.sleep(0.8 * attempt)
-                            try:
-                                page.evaluate("window.scrollTo(0, 0);")
-                            except Exception:
-                                pass
-                            continue
-                        sys.stderr.write("[WARN] {}: {}\n".format(cur.isoformat(), last_error))
-                        writer.writerow([cur.isoformat(), ""])
-                        time.sleep(POLITE_DELAY_BETWEEN_DAYS_SEC)
-
-                cur += timedelta(days=1)
-
-        browser.close()
+            # Give you time to log in if needed
+            # (We’ll also proceed immediately if the elements are already present.)
+            await wait_for_form(page, LOGIN_WAIT_SEC)
+
+        await block_nonessential(context, after_login=True)
+
+        # CSV (appending to the existing file when resuming)
+        with open(args.out, "a" if resume else "w", newline="", encoding="utf-8", buffering=CSV_BUFFER_BYTES) as f:
+            writer = CsvWriterTask(f)
+            if not resume:
+                await writer.writerow(["date", "close"])
+            limiter = RateLimiter(MAX_DAYS_PER_SEC)
+            try:
+                # 2) Optionally skip the browser: learn the backend request from one date, replay the rest
+                if args.replay_api and remaining:
+                    first = remaining.pop(0)
+                    first_text, templates = await capture_replay_templates(page, first)
+                    if first_text is None:
+                        remaining.insert(0, first)
+                    else:
+                        await writer.writerow([first[0], clean_price(first_text) if args.clean_price else first_text])
+                    if first_text and templates:
+                        remaining = await replay_dates(context, templates, (first, first_text), remaining,
+                                                       writer, limiter, args)
+                    else:
+                        sys.stderr.write("[WARN] No replayable price request seen; using the browser.\n")
+
+                # 3) Extra workers reuse the logged-in session (cookies + local storage)
+                pages = [page]
+                if args.concurrency > 1 and len(remaining) > 1:
+                    state = await context.storage_state() if browser else None
+                    extra = await asyncio.gather(*[
+                        open_worker_page(browser, context, state, args.url) for _ in range(args.concurrency - 1)
+                    ])
+                    pages += [pg for pg in extra if pg]
+
+                dates: "asyncio.Queue[Day]" = asyncio.Queue()
+                for d in remaining:
+                    dates.put_nowait(d)
+                await asyncio.gather(*[
+                    staggered(i * WORKER_STAGGER_SEC, worker(pg, dates, writer, limiter, args))
+                    for i, pg in enumerate(pages)
+                ])
+            finally:
+                # Keep whatever was scraped even if a worker blew up
+                await writer.close()
+
+        await (browser or context).close()
     print("Done. Wrote CSV to: {}".format(args.out))
 
 if __name__ == "__main__":
     main()
-